@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
-# Compare DNS records between two DNS servers.
+# Compare DNS records between two (or more) DNS servers.
 # Usage:
-#     python compare-dns.py <IP1> <IP2> <records.csv>
+#     python compare-dns.py [options] <IP1> <IP2> [<IP3> ...] <records.csv>
 #
 # CSV format:
 #     fqdn,type
@@ -10,165 +10,2537 @@
 # Example:
 #     google.com,A
 #     example.org,MX
+#
+# make-records.py builds such a CSV from zone transfers or zone files.
+#
+# With more than two servers each record is looked up once per server and
+# the servers that disagree with the majority answer are reported. Use
+# --reference to compare every server against one designated server (for
+# example the grid master) instead.
+#
+# Options:
+#     --reference IP      Server the others are compared against
+#     --engine sequential|asyncio|threads|pipelined
+#                         How queries are issued (default: sequential).
+#                         "asyncio" keeps several records in flight at once
+#                         using dns.asyncresolver, "threads" hands records to
+#                         a pool of worker threads using dns.resolver, and
+#                         "pipelined" sends prebuilt queries over a few raw
+#                         sockets or connections per server (thousands in
+#                         flight).
+#     --concurrency N     Records in flight with --engine asyncio or pipelined
+#                         (default: 32)
+#     --workers N         Worker threads with --engine threads (default: 32).
+#                         Giving --workers on its own selects --engine threads.
+#     --transport udp|tcp Transport for --engine pipelined (default: udp).
+#                         "tcp" pipelines queries over long-lived connections
+#                         (RFC 7766). Giving --transport on its own selects
+#                         --engine pipelined.
+#     --sockets N         UDP sockets or TCP connections per server with
+#                         --engine pipelined (default: 4)
+#     --timeout SECONDS   Per-try timeout with --engine pipelined, and the
+#                         longest wait for each message of a zone transfer
+#                         with --axfr (default: 2.0)
+#     --retries N         Resends of an unanswered query with --engine
+#                         pipelined (default: 2)
+#     --qps N             Limit the queries/sec sent to each server (token
+#                         bucket, one per server)
+#     --adaptive          Tune each server's rate during the run: halve it when
+#                         timeouts or SERVFAILs rise, otherwise raise it step
+#                         by step. Starts at --qps (default: 100).
+#     --max-qps N         Upper limit for --adaptive
+#     --processes N       Split the CSV into N byte ranges and compare them in
+#                         N worker processes, each running the chosen engine.
+#                         The per-process results are merged into the usual
+#                         output files, still in input order. --qps and
+#                         --max-qps are shared out evenly between the workers.
+#     --resume TIMESTAMP  Carry on with an interrupted run, e.g. --resume
+#                         20240101-120000. Rows already compared are skipped and
+#                         the run's existing output files are appended to. Give
+#                         the same servers, CSV and --processes as the first run.
+#     --keep-duplicates   Query every row. By default a row repeating the name
+#                         (ignoring case and a trailing dot) and type of an
+#                         earlier row is logged as a duplicate of that line
+#                         and not queried again.
+#     --incremental FILE  Keep every record's latest result in the SQLite file
+#                         FILE and only query rows that are new, mismatched or
+#                         failed last time, or whose zone's SOA serial has
+#                         changed on any server since they were compared. The
+#                         other rows are logged as unchanged without querying.
+#     --trust-soa         Ask every server for the SOA serial (and ZONEMD
+#                         digest, if the zone has one) of each zone in the
+#                         CSV first, and log the rows of zones whose serials
+#                         all match as identical without querying them
+#     --log-level summary|mismatches|full
+#                         What the main log records for each row: "full" (the
+#                         default) logs every row with its answers,
+#                         "mismatches" only mismatches and bad rows, and
+#                         "summary" only the final counts. The other output
+#                         files are the same at every level.
+#     --compress gzip|zstd
+#                         Write the output files through a streaming
+#                         compressor (.gz or .zst added to their names). zstd
+#                         needs the zstandard package. Not with --resume.
+#     --compress-level N  Compression level (gzip 1-9, default 6; zstd 1-22,
+#                         default 3)
+#     --no-jsonl          Do not write output/<timestamp>_results.jsonl, which
+#                         otherwise holds one JSON object per row: line, name,
+#                         type, verdict and each server's answer, rcode and
+#                         latency in seconds. The file renders the answer text
+#                         of identical records too, so on large runs it costs
+#                         the formatting that --log-level summary|mismatches
+#                         saves; add --no-jsonl to save it.
+#     --prometheus FILE   Keep the run's metrics in FILE, in Prometheus text
+#                         format for node_exporter's textfile collector
+#                         (records tested, mismatches, exceptions, per-server
+#                         latency quantiles, timeouts and rcodes, duration).
+#                         Rewritten atomically every 15s and at the end.
+#     --rules FILE        Per-type comparison rules, see below
+#     --axfr              The input file lists zones (one per line) instead of
+#                         records. Each zone is transferred from every server
+#                         at once and every name and type in any copy is
+#                         compared, written to the same output files.
+#     --zone-files        Compare zone files instead of servers, offline: give a
+#                         zone file or a directory of them in place of each
+#                         IP, and a file listing the zones as with --axfr. A
+#                         directory is searched for <zone>, <zone>.zone,
+#                         <zone>.db or db.<zone>. One zone is loaded at a time.
+#     --ixfr-cache DIR    With --axfr, keep every server's copy of each zone in
+#                         DIR and bring it up to date by IXFR on the next run.
+#                         Only names changed on some server since then, or
+#                         that disagreed last time, are compared again; the
+#                         rest are logged as unchanged. A server answering
+#                         with a full transfer is handled as a plain AXFR.
+#
+# A rules file relaxes how the answers for some record types are compared,
+# one type per line followed by its rules:
+#
+#     # type  rules
+#     A       superset
+#     SOA     serial-within 10
+#     TXT     join
+#
+#     superset          An answer with every record of the expected answer
+#                       (and more) still agrees
+#     serial-within N   SOA serials may differ by up to N
+#     join              TXT/SPF strings are joined before comparing, so how a
+#                       value is split into strings does not matter
+#     set, ignore-ttl   Accepted for clarity: records are always compared as a
+#                       set, and TTLs are never compared
+#
+# At the end of a run each server's latency percentiles, timeouts and response
+# codes are printed, and written in full to output/<timestamp>_stats.json.
+#
+# Every run keeps a small journal (output/<timestamp>_compare-dns.journal)
+# recording how far it has got; it is what --resume reads.
+#
+# Output files are identical whichever engine is used: results are written
+# in input order. When stdout is a terminal a progress line shows records/sec,
+# the mismatch rate and an ETA.
 
 import sys
 import time
 import csv
+import argparse
+import asyncio
+import bisect
+import collections
+import threading
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import json
+import sqlite3
+import multiprocessing
+import os
+import shutil
+import random
+import selectors
+import socket
+import struct
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
 import dns.resolver
+import dns.asyncresolver
+import dns.xfr
+import dns.zone
 from datetime import datetime
 
 
 # -------------------------
-# Spinner for progress
+# Progress reporting
 # -------------------------
-def spinning_cursor():
-    while True:
-        for cursor in "|/-\\":
-            yield cursor
+class Progress:
+    """Status line redrawn by a background thread, so the query loop never waits on it.
 
+    Shows records/sec, mismatch rate and an ETA. Nothing is drawn when stdout
+    is not a TTY (cron, redirects); messages are then printed as plain lines.
+    """
 
-def spin(spinner):
-    global loopCount
-    loopCount += 1
-    time.sleep(0.02)
-    sys.stdout.write(next(spinner))
-    sys.stdout.flush()
-    sys.stdout.write('\b')
+    def __init__(self, inputCsv, interval=0.5, enabled=None, counts=None):
+        self.inputCsv = inputCsv
+        self.interval = interval
+        self.enabled = sys.stdout.isatty() if enabled is None else enabled
+        self.counts = counts or (lambda: (loopCount, mismatchCount))
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.total = None
+        self.width = 0
+
+    def start(self):
+        self.startTime = time.monotonic()
+        # Records carried over by --resume do not count towards the rate
+        self.baseline = self.counts()[0]
+        if self.enabled:
+            self.thread.start()
+
+    def run(self):
+        # Counting rows for the ETA is done here rather than before the run starts.
+        if self.inputCsv is not None:
+            total = 0
+            for _ in read_records(self.inputCsv):
+                total += 1
+                if self.stopped.is_set():
+                    return
+            self.total = total
+
+        while not self.stopped.wait(self.interval):
+            self.draw()
 
-    if loopCount % 100 == 0:
-        sys.stdout.write("\b" * 30)
-        print(f"{loopCount} records tested ", end="")
+    def draw(self):
+        done, mismatches = self.counts()
+        elapsed = time.monotonic() - self.startTime
+        rate = (done - self.baseline) / elapsed if elapsed > 0 else 0.0
+        mismatchRate = 100.0 * mismatches / done if done else 0.0
+
+        status = f"{done} records tested, {rate:.0f}/s, {mismatchRate:.1f}% mismatched"
+        if self.total is not None and rate > 0:
+            remaining = int(max(self.total - done, 0) / rate)
+            status += f", ETA {remaining // 3600}:{remaining // 60 % 60:02d}:{remaining % 60:02d}"
+
+        with self.lock:
+            sys.stdout.write("\r" + status.ljust(self.width))
+            sys.stdout.flush()
+            self.width = len(status)
+
+    def clear(self):
+        if self.width:
+            sys.stdout.write("\r" + " " * self.width + "\r")
+            self.width = 0
+
+    def message(self, msg):
+        """Print a line without tearing the status line."""
+        with self.lock:
+            self.clear()
+            print(msg)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            self.clear()
+            sys.stdout.flush()
 
 
 # -------------------------
 # Argument Check
 # -------------------------
-if len(sys.argv) != 4:
-    print(f"Usage: {sys.argv[0]} IP1 IP2 records.csv")
-    sys.exit(1)
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare DNS records between two or more DNS servers.'
+    )
+    parser.add_argument('servers', nargs='+', metavar='IP', help='DNS servers to compare')
+    parser.add_argument('input_csv', help='CSV file of fqdn,type rows')
+    parser.add_argument('--reference', metavar='IP',
+                        help='Compare every server against this one instead of the majority')
+    parser.add_argument('--engine', choices=['sequential', 'asyncio', 'threads', 'pipelined'],
+                        help='How queries are issued (default: sequential)')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Records in flight with --engine asyncio or pipelined (default: 32)')
+    parser.add_argument('--workers', type=int,
+                        help='Worker threads with --engine threads (default: 32)')
+    parser.add_argument('--transport', choices=['udp', 'tcp'],
+                        help='Transport for --engine pipelined (default: udp)')
+    parser.add_argument('--sockets', type=int, default=4,
+                        help='UDP sockets or TCP connections per server with --engine pipelined (default: 4)')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='Per-try timeout in seconds with --engine pipelined, and per message '
+                             'of a zone transfer with --axfr (default: 2.0)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Resends of an unanswered query with --engine pipelined (default: 2)')
+    parser.add_argument('--qps', type=float,
+                        help='Limit the queries/sec sent to each server')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Tune each server\'s rate from its timeouts and SERVFAILs, starting at --qps (default: 100)')
+    parser.add_argument('--max-qps', type=float,
+                        help='Upper limit for --adaptive')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes, each comparing one part of the CSV (default: 1)')
+    parser.add_argument('--axfr', action='store_true',
+                        help='The input file lists zones; compare them by zone transfer')
+    parser.add_argument('--zone-files', action='store_true',
+                        help='Compare zone files or directories given in place of the IPs; the input file lists zones')
+    parser.add_argument('--ixfr-cache', metavar='DIR',
+                        help='With --axfr, cache the zones in DIR and update them by IXFR')
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default='full',
+                        help='What the main log records per row (default: full)')
+    parser.add_argument('--compress', choices=['gzip', 'zstd'],
+                        help='Write the output files compressed')
+    parser.add_argument('--compress-level', type=int, metavar='N',
+                        help='Compression level (gzip 1-9, default 6; zstd 1-22, default 3)')
+    parser.add_argument('--no-jsonl', dest='jsonl', action='store_false',
+                        help='Do not write the JSON Lines results file (it renders every answer, identical '
+                             'ones included, which costs what --log-level summary|mismatches saves)')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='Keep run metrics in FILE in Prometheus text format (textfile collector)')
+    parser.add_argument('--rules', metavar='FILE',
+                        help='Per-type comparison rules (superset, serial-within N, join)')
+    parser.add_argument('--trust-soa', action='store_true',
+                        help="Skip the rows of zones whose SOA serial is the same on every server")
+    parser.add_argument('--keep-duplicates', action='store_true',
+                        help='Query every row, even one repeating an earlier name and type')
+    parser.add_argument('--incremental', metavar='FILE',
+                        help='Result store (SQLite); only re-query rows that changed or failed since the last run')
+    parser.add_argument('--resume', metavar='TIMESTAMP',
+                        help='Carry on with the interrupted run whose output files have this timestamp')
+
+    args = parser.parse_args()
+    if len(args.servers) < 2:
+        parser.error('at least two DNS servers are needed')
+    if args.reference is not None and args.reference not in args.servers:
+        parser.error('--reference must be one of the servers being compared')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.sockets < 1:
+        parser.error('--sockets must be at least 1')
+    if args.timeout <= 0:
+        parser.error('--timeout must be positive')
+    if args.retries < 0:
+        parser.error('--retries cannot be negative')
+    if args.processes < 1:
+        parser.error('--processes must be at least 1')
+    if args.resume is not None:
+        try:
+            datetime.strptime(args.resume, '%Y%m%d-%H%M%S')
+        except ValueError:
+            parser.error('--resume takes a run timestamp such as 20240101-120000')
+    if args.compress_level is not None:
+        if args.compress is None:
+            parser.error('--compress-level can only be used with --compress')
+        if not 1 <= args.compress_level <= (9 if args.compress == 'gzip' else 22):
+            parser.error(f'--compress-level is out of range for {args.compress}')
+    if args.compress is not None and args.resume is not None:
+        parser.error('--resume cannot be used with --compress')
+    if args.compress == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            parser.error('--compress zstd needs the zstandard package (pip install zstandard)')
+    if args.rules is not None:
+        try:
+            load_rules(args.rules)
+        except (OSError, ValueError) as ex:
+            parser.error(f'--rules: {ex}')
+    if args.qps is not None and args.qps <= 0:
+        parser.error('--qps must be positive')
+    if args.max_qps is not None:
+        if not args.adaptive:
+            parser.error('--max-qps can only be used with --adaptive')
+        if args.max_qps < (args.qps or 100):
+            parser.error('--max-qps cannot be below the starting rate')
+
+    if args.ixfr_cache is not None and not args.axfr:
+        parser.error('--ixfr-cache can only be used with --axfr')
+    if args.axfr and args.zone_files:
+        parser.error('--axfr and --zone-files cannot be used together')
+    if args.axfr or args.zone_files:
+        mode = '--axfr' if args.axfr else '--zone-files'
+        for option in ('processes', 'incremental', 'resume', 'trust_soa', 'qps', 'adaptive'):
+            if getattr(args, option) not in (None, 1, False):
+                parser.error(f'--{option.replace("_", "-")} cannot be used with {mode}')
+
+    if args.workers is not None and args.transport is not None:
+        parser.error('--workers and --transport cannot be used together')
+    if args.engine is None:
+        if args.workers is not None:
+            args.engine = 'threads'
+        elif args.transport is not None:
+            args.engine = 'pipelined'
+        else:
+            args.engine = 'sequential'
+    elif args.workers is not None and args.engine != 'threads':
+        parser.error('--workers can only be used with --engine threads')
+    elif args.transport is not None and args.engine != 'pipelined':
+        parser.error('--transport can only be used with --engine pipelined')
+    if args.workers is None:
+        args.workers = 32
+    if args.transport is None:
+        args.transport = 'udp'
+    return args
+
+
+# -------------------------
+# Input
+# -------------------------
+def read_records(inputCsv, start=0, end=None, firstLine=1):
+    """Yield (lineNumber, recName, recType, badData) for every data row of the CSV.
+
+    start and end limit reading to a byte range beginning at a line boundary
+    (see shard_ranges()); firstLine is the line number of the line at start.
+    """
+    def lines(csvfile):
+        position = start
+        for line in csvfile:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line.decode()
+
+    with open(inputCsv, "rb") as csvfile:
+        csvfile.seek(start)
+        reader = csv.reader(lines(csvfile))
+
+        for i, line in enumerate(reader, firstLine):
+            # Skip blank or commented lines
+            if not line or line[0].strip() == "" or line[0].startswith("#"):
+                continue
+
+            try:
+                recName = line[0].strip()
+                recType = line[1].strip()
+            except Exception as exIndex:
+                yield i, None, None, exIndex
+                continue
+
+            yield i, recName, recType, None
+
+
+def canonical_name(name):
+    return name.strip().rstrip(".").lower()
+
+
+class Duplicate:
+    """Marks a repeat of an earlier (fqdn, type) row (in place of badData); it is not queried."""
+
+    def __init__(self, line):
+        self.line = line
+
+
+def dedup_records(records, seen=None):
+    """Replace the badData of every repeated (fqdn, type) row with a Duplicate of its first line.
+
+    Names are compared case-insensitively and without a trailing dot. seen
+    maps the pairs already met (e.g. earlier in the CSV than a shard) to
+    their first line, and is updated as records pass.
+    """
+    if seen is None:
+        seen = {}
+    for record in records:
+        if record[3] is None:
+            key = (canonical_name(record[1]), record[2].upper())
+            first = seen.setdefault(key, record[0])
+            if first != record[0]:
+                record = (record[0], record[1], record[2], Duplicate(first))
+        yield record
+
+
+def input_records(args, start=0, end=None, firstLine=1):
+    """Read the records of the CSV (or of a byte range of it) that the run should go through."""
+    records = read_records(args.input_csv, start, end, firstLine)
+    if args.keep_duplicates:
+        return records
+    seen = {}
+    if start > 0:
+        collections.deque(dedup_records(read_records(args.input_csv, 0, start), seen), maxlen=0)
+    return dedup_records(records, seen)
+
+
+# -------------------------
+# Rate limiting
+# -------------------------
+class RateLimiter:
+    """Token bucket for the queries sent to one server; safe to share between threads.
+
+    With adaptive=True the rate is adjusted once a second (AIMD): it is halved
+    when more than OVERLOAD_RATIO of that second's answers were timeouts or
+    SERVFAILs, and raised by a tenth of the starting rate when the bucket was
+    what held queries back, up to `ceiling`.
+    """
+
+    OVERLOAD_RATIO = 0.01
+    MIN_RATE = 1.0
+
+    def __init__(self, rate, adaptive=False, ceiling=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.step = max(1.0, rate / 10)
+        self.adaptive = adaptive
+        self.ceiling = ceiling
+        self.tokens = self.burst = max(1.0, rate / 10)
+        self.updated = time.monotonic()
+        self.windowStart = self.updated
+        self.answers = 0
+        self.overloads = 0
+        self.limited = False
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token, returning how long the caller must wait before sending."""
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            self.limited = True
+            return -self.tokens / self.rate
+
+    def take(self):
+        """Take a token if one is available now, without waiting."""
+        with self.lock:
+            self.refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.limited = True
+            return False
+
+    def wait(self):
+        """Seconds until take() can succeed."""
+        with self.lock:
+            self.refill(time.monotonic())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def record(self, overload):
+        """Count an answer for the adaptive rate; overload is True for timeouts and SERVFAILs."""
+        if not self.adaptive:
+            return
+        with self.lock:
+            self.answers += 1
+            self.overloads += overload
+            now = time.monotonic()
+            if now - self.windowStart < 1.0:
+                return
+
+            self.refill(now)
+            if self.overloads > self.answers * self.OVERLOAD_RATIO:
+                self.rate = max(self.MIN_RATE, self.rate / 2)
+            elif self.limited:
+                self.rate += self.step
+                if self.ceiling is not None:
+                    self.rate = min(self.rate, self.ceiling)
+            self.burst = max(1.0, self.rate / 10)
+            self.tokens = min(self.tokens, self.burst)
+            self.windowStart = now
+            self.answers = 0
+            self.overloads = 0
+            self.limited = False
+
+
+def overloaded(ex):
+    """True for failures that suggest a server is shedding load: timeouts and SERVFAIL."""
+    if isinstance(ex, dns.exception.Timeout):
+        return True
+    if isinstance(ex, dns.resolver.NoNameservers):
+        return any(error[3] == "SERVFAIL" for error in ex.kwargs.get("errors") or [])
+    return False
 
-ip1 = [sys.argv[1]]
-ip2 = [sys.argv[2]]
-inputCsv = sys.argv[3]
 
 # -------------------------
-# Output filenames
+# Lookups
 # -------------------------
-now = datetime.now()
-timeString = now.strftime('%Y%m%d-%H%M%S')
+def make_resolver(server, resolverClass=dns.resolver.Resolver):
+    resolver = resolverClass(configure=False)
+    resolver.nameservers = [server]
+    return resolver
+
+
+def format_answer(answer):
+    return sorted([str(a).lower() for a in answer])
+
+
+# Types compared on their wire form first: their rdata holds no names, so the
+# wire form costs a fraction of the text (quoted strings, hex and base64).
+# Names are slower to encode than to print, and an address prints cheaply.
+WIRE_COMPARED_TYPES = frozenset(dns.rdatatype.from_text(rdtype) for rdtype in (
+    "TXT", "SPF", "HINFO", "CAA", "DS", "CDS", "DNSKEY", "CDNSKEY", "SSHFP", "TLSA", "SMIMEA", "ZONEMD"))
+
+
+class CanonicalAnswer:
+    """One server's answer, compared on its canonical wire form before its text.
+
+    The wire form is each rdata in RFC 4034 canonical form (names in the
+    rdata lowercased), sorted in canonical order and length-prefixed. Equal
+    wire forms always have equal text, so for WIRE_COMPARED_TYPES the text is
+    only rendered when the wire forms differ or the answer is logged. Both
+    forms are built on first use. A failed lookup has text only.
+    """
+
+    __slots__ = ("rdatas", "_wire", "_text", "rcode", "latency", "error")
+
+    def __init__(self, rdatas=None, text=None, rcode=None, latency=None, error=None):
+        self.rdatas = rdatas
+        self._wire = None
+        self._text = text
+        # Response code (text, None if there was no response), seconds taken
+        # and the exception a failed lookup raised
+        self.rcode = rcode
+        self.latency = latency
+        self.error = error
+
+    @property
+    def wire(self):
+        if self._wire is None and self.rdatas is not None:
+            self._wire = b"".join(len(wire).to_bytes(2, "big") + wire
+                                  for wire in sorted(rdata.to_digestable() for rdata in self.rdatas))
+        return self._wire
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = format_answer(self.rdatas)
+        return self._text
+
+    def __eq__(self, other):
+        if self.rdatas is not None and other.rdatas is not None \
+                and self.rdatas.rdtype in WIRE_COMPARED_TYPES and self.wire == other.wire:
+            return True
+        return self.text == other.text
+
+    def digest(self):
+        data = self.wire if self.wire is not None else repr(self.text).encode()
+        return hashlib.sha1(data).hexdigest()[:16]
+
+
+def exception_rcode(ex):
+    """Return the response code behind a failed lookup, or None if no response came back."""
+    if isinstance(ex, dns.resolver.NXDOMAIN):
+        return "NXDOMAIN"
+    if isinstance(ex, dns.resolver.NoAnswer):
+        return "NOERROR"
+    if isinstance(ex, dns.resolver.YXDOMAIN):
+        return "YXDOMAIN"
+    if isinstance(ex, dns.resolver.NoNameservers):
+        for error in reversed(ex.kwargs.get("errors") or []):
+            if error[4] is not None:
+                return dns.rcode.to_text(error[4].rcode())
+    return None
+
+
+def failed_lookup(server, recName, recType, ex, latency=None):
+    """Return the (answer, exception message) pair recorded for a failed lookup."""
+    return CanonicalAnswer(text=format_answer([f"bad response \"{ex}\""]),
+                           rcode=exception_rcode(ex), latency=latency, error=ex), \
+        f"Exception from {[server]}: {recName} {recType}: \"{ex}\""
+
+
+def answered_lookup(answer, latency):
+    return CanonicalAnswer(answer, rcode=dns.rcode.to_text(answer.response.rcode()), latency=latency), None
+
+
+def lookup(resolver, server, recName, recType):
+    """Resolve one record, returning (answer, exception message or None)."""
+    limiter = limiters.get(server)
+    if limiter is not None:
+        time.sleep(limiter.reserve())
+    started = time.monotonic()
+    try:
+        answer = resolver.resolve(recName, recType)
+    except Exception as ex:
+        if limiter is not None:
+            limiter.record(overloaded(ex))
+        return failed_lookup(server, recName, recType, ex, time.monotonic() - started)
+    if limiter is not None:
+        limiter.record(False)
+    return answered_lookup(answer, time.monotonic() - started)
+
+
+async def lookup_async(resolver, server, recName, recType):
+    """Coroutine version of lookup() for dns.asyncresolver resolvers."""
+    limiter = limiters.get(server)
+    if limiter is not None:
+        await asyncio.sleep(limiter.reserve())
+    started = time.monotonic()
+    try:
+        answer = await resolver.resolve(recName, recType)
+    except Exception as ex:
+        if limiter is not None:
+            limiter.record(overloaded(ex))
+        return failed_lookup(server, recName, recType, ex, time.monotonic() - started)
+    if limiter is not None:
+        limiter.record(False)
+    return answered_lookup(answer, time.monotonic() - started)
+
+
+def make_result(record, lookups):
+    lineNumber, recName, recType, badData = record
+    return {
+        "line": lineNumber,
+        "name": recName,
+        "type": recType,
+        "bad": badData if isinstance(badData, Exception) else None,
+        "unchanged": SKIP_REASONS.get(badData),
+        "duplicate": badData.line if isinstance(badData, Duplicate) else None,
+        "answers": [answer for answer, _ in lookups],
+        "exceptions": [msg for _, msg in lookups if msg is not None],
+    }
 
-logFilename = f"output/{timeString}_compare-dns.log"
-identicalLogFilename = f"output/{timeString}_identical.txt"
-problemsFilename = f"output/{timeString}_problems.csv"
-errFilename = f"output/{timeString}_compare-dns.errors"
-exceptionsFilename = f"output/{timeString}_compare-dns.exceptions"
 
 # -------------------------
-# DNS Resolvers
+# Comparison core
 # -------------------------
-res1 = dns.resolver.Resolver(configure=False)
-res1.nameservers = ip1
+# All servers are queried at the same time, so a record costs the slowest
+# round trip rather than the sum of them.
+def compare_record(record, resolvers, helper):
+    """Look a record up on every server, using helper threads for all but the first."""
+    if record[3] is not None:
+        return make_result(record, [])
+
+    recName, recType = record[1], record[2]
+    others = [helper.submit(lookup, resolver, server, recName, recType)
+              for resolver, server in zip(resolvers[1:], servers[1:])]
+    first = lookup(resolvers[0], servers[0], recName, recType)
+    return make_result(record, [first] + [future.result() for future in others])
+
 
-res2 = dns.resolver.Resolver(configure=False)
-res2.nameservers = ip2
+async def compare_async(semaphore, resolvers, record):
+    if record[3] is not None:
+        return make_result(record, [])
 
-spinner = spinning_cursor()
-loopCount = 0
-exceptionCount = 0
-mismatchCount = 0
+    recName, recType = record[1], record[2]
+    async with semaphore:
+        return make_result(record, await asyncio.gather(*[
+            lookup_async(resolver, server, recName, recType)
+            for resolver, server in zip(resolvers, servers)
+        ]))
+
+
+def disagreeing_servers(answers, recType):
+    """Return the indexes of the servers whose answer differs from the expected one.
+
+    The expected answer is the --reference server's when one was given, otherwise
+    the most common answer (a tie goes to the server listed first). The --rules
+    for recType decide what still counts as agreeing with it. With more than
+    two servers a failed lookup is voted on how it failed, as its message
+    names the server (and the time a timeout took).
+    """
+    first = answers[0]
+    if all(answer == first for answer in answers[1:]):
+        return []
+
+    comparator = comparators.get(recType.upper(), DEFAULT_COMPARATOR)
+    keys = [("failed", type(answer.error).__name__, answer.rcode)
+            if answer.error is not None and len(servers) > 2 else comparator.key(answer)
+            for answer in answers]
+    if referenceIndex is not None:
+        expected = referenceIndex
+    else:
+        votes = collections.Counter(keys)
+        expected = max(range(len(keys)), key=lambda i: votes[keys[i]])
+    return [i for i in range(len(answers))
+            if keys[i] != keys[expected] and not comparator.agrees(answers[expected], answers[i])]
 
 
 # -------------------------
-# MAIN LOGIC
+# Comparison rules
 # -------------------------
-with open(problemsFilename, "w") as problemsFile, \
-     open(identicalLogFilename, "w") as identicalLog, \
-     open(exceptionsFilename, "w") as exceptionLog, \
-     open(errFilename, "w") as errlogfile, \
-     open(logFilename, "w") as logfile:
-
-    print()
-    print(f"Starting DNS compare between {ip1} versus {ip2}")
-    print(f"Log file: {logFilename}")
-    print(f"Errors logged in: {errFilename}")
-    print(f"Exceptions logged in: {exceptionsFilename}")
-    print(f"Problem items logged in: {problemsFilename}")
-    print(f"Identical items logged in: {identicalLogFilename}")
-    print("-----------------------------\n")
-
-    # Mirror logs inside file
-    for line in [
-        f"Starting DNS compare between {ip1} versus {ip2}",
-        f"Log file: {logFilename}",
-        f"Errors logged in: {errFilename}",
-        f"Exceptions logged in: {exceptionsFilename}",
-        f"Problem items logged in: {problemsFilename}",
-        f"Identical items logged in: {identicalLogFilename}",
-        "-----------------------------"
-    ]:
-        print(line, file=logfile)
-
-    # Read CSV input file
-    with open(inputCsv, "r") as csvfile:
-        reader = csv.reader(csvfile)
-
-        for i, line in enumerate(reader):
-            # Skip blank or commented lines
+def serial_distance(a, b):
+    """Distance between two SOA serials in RFC 1982 serial number arithmetic."""
+    return min((a - b) % 2**32, (b - a) % 2**32)
+
+
+class Comparator:
+    """How the answers for one record type are compared, compiled from --rules.
+
+    key() is what the servers' answers are voted on, and agrees() is asked
+    only when an answer's key differs from the expected one; its checks are
+    picked once, when the rules are loaded.
+    """
+
+    def __init__(self, join=False, superset=False, serialWithin=None):
+        self.key = self.joined_key if join else self.text_key
+        self.serialWithin = serialWithin
+        self.checks = []
+        if superset:
+            self.checks.append(self.is_superset)
+        if serialWithin is not None:
+            self.checks.append(self.serial_close)
+
+    @staticmethod
+    def text_key(answer):
+        return tuple(answer.text)
+
+    @staticmethod
+    def joined_key(answer):
+        if answer.rdatas is None:
+            return tuple(answer.text)
+        return tuple(sorted('"' + b"".join(rdata.strings).decode(errors="replace").lower() + '"'
+                            for rdata in answer.rdatas))
+
+    def agrees(self, expected, answer):
+        if expected.rdatas is None or answer.rdatas is None:
+            return False
+        return any(check(expected, answer) for check in self.checks)
+
+    def is_superset(self, expected, answer):
+        return set(self.key(answer)) >= set(self.key(expected))
+
+    def serial_close(self, expected, answer):
+        if len(expected.rdatas) != 1 or len(answer.rdatas) != 1:
+            return False
+        soa, other = list(expected.rdatas)[0], list(answer.rdatas)[0]
+        return serial_distance(soa.serial, other.serial) <= self.serialWithin \
+            and str(soa.replace(serial=0)).lower() == str(other.replace(serial=0)).lower()
+
+
+DEFAULT_COMPARATOR = Comparator()
+
+
+def load_rules(filename):
+    """Compile a --rules file into a Comparator for every record type it names."""
+    comparators = {}
+    with open(filename, "r") as rulesFile:
+        for lineNumber, line in enumerate(rulesFile, 1):
+            words = line.split("#")[0].split()
+            if not words:
+                continue
+
+            rdtype = words[0].upper()
+            try:
+                dns.rdatatype.from_text(rdtype)
+            except dns.rdatatype.UnknownRdatatype:
+                raise ValueError(f"line {lineNumber}: unknown record type {words[0]}")
+            options = {}
+            rules = iter(words[1:])
+            for rule in rules:
+                if rule == "superset":
+                    options["superset"] = True
+                elif rule == "join" and rdtype in ("TXT", "SPF"):
+                    options["join"] = True
+                elif rule == "serial-within" and rdtype == "SOA":
+                    try:
+                        options["serialWithin"] = int(next(rules))
+                    except (StopIteration, ValueError):
+                        raise ValueError(f"line {lineNumber}: serial-within needs a number")
+                elif rule not in ("set", "ignore-ttl"):
+                    raise ValueError(f"line {lineNumber}: rule {rule} does not apply to {rdtype}")
+            comparators[rdtype] = Comparator(**options)
+    return comparators
+
+
+# -------------------------
+# Engines
+# -------------------------
+def run_sequential(records, files):
+    resolvers = [make_resolver(server) for server in servers]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers) - 1) as helper:
+        for record in records:
+            write_result(compare_record(record, resolvers, helper), files)
+
+
+async def run_asyncio(records, files, concurrency):
+    resolvers = [make_resolver(server, dns.asyncresolver.Resolver) for server in servers]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Results are written in input order, so keep a bounded window of
+    # scheduled records and always wait on the oldest one.
+    window = collections.deque()
+    for record in records:
+        window.append(asyncio.ensure_future(compare_async(semaphore, resolvers, record)))
+        if len(window) >= concurrency * 2:
+            write_result(await window.popleft(), files)
+
+    while window:
+        write_result(await window.popleft(), files)
+
+
+def run_threads(records, files, workers):
+    # dns.resolver.Resolver objects are not shared between threads: each
+    # worker builds its own set the first time it picks up a record.
+    local = threading.local()
+
+    def compare(record):
+        if not hasattr(local, "resolvers"):
+            local.resolvers = [make_resolver(server) for server in servers]
+        return compare_record(record, local.resolvers, helper)
+
+    # Only this thread writes output, oldest submitted record first.
+    # Each worker needs helper threads of its own for the other servers.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers * (len(servers) - 1)) as helper, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        window = collections.deque()
+        for record in records:
+            window.append(executor.submit(compare, record))
+            if len(window) >= workers * 2:
+                write_result(window.popleft().result(), files)
+
+        while window:
+            write_result(window.popleft().result(), files)
+
+
+# -------------------------
+# Pipelined engine
+# -------------------------
+def nameserver_text(server):
+    # Matches how dns.resolver names a server in its error messages
+    return f"Do53:{server}@53"
+
+
+def answer_from_response(server, request, response):
+    """Apply dns.resolver's rules to a raw response, raising what resolve() would raise."""
+    question = request.question[0]
+    rcode = response.rcode()
+
+    if rcode == dns.rcode.NOERROR:
+        answer = dns.resolver.Answer(question.name, question.rdtype, dns.rdataclass.IN, response)
+        if answer.rrset is None:
+            raise dns.resolver.NoAnswer(response=response)
+        return answer
+    if rcode == dns.rcode.NXDOMAIN:
+        raise dns.resolver.NXDOMAIN(qnames=[question.name], responses={question.name: response})
+    if rcode == dns.rcode.YXDOMAIN:
+        raise dns.resolver.YXDOMAIN()
+    raise dns.resolver.NoNameservers(request=request, errors=[
+        (nameserver_text(server), False, 53, dns.rcode.to_text(rcode), response)
+    ])
+
+
+def server_family(server):
+    return socket.AF_INET6 if ":" in server else socket.AF_INET
+
+
+class UdpChannel:
+    """A connected, non-blocking UDP socket to one server."""
+
+    def __init__(self, selector, server):
+        self.selector = selector
+        self.sock = socket.socket(server_family(server), socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.connect((server, 53))
+        selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def send(self, data):
+        try:
+            self.sock.send(data)
+        except OSError:
+            # Left pending: the query is resent or failed when it times out.
+            pass
+
+    def write(self):
+        pass
+
+    def read(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.sock.recv(65535))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP errors surface here; the affected queries time out.
+                break
+        return messages
+
+    def close(self):
+        self.selector.unregister(self.sock)
+        self.sock.close()
+
+
+class TcpChannel:
+    """A long-lived TCP connection to one server carrying pipelined queries (RFC 7766).
+
+    Queries are length-prefixed and written as soon as the socket accepts
+    them, without waiting for earlier answers, which may come back in any
+    order. If the connection fails or the server closes it, `dropped` is set
+    to the error and the connection is reopened by the next send.
+    """
+
+    def __init__(self, selector, server):
+        self.selector = selector
+        self.server = server
+        self.sock = None
+        self.dropped = None
+
+    def open(self):
+        self.sock = socket.socket(server_family(self.server), socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect_ex((self.server, 53))
+        self.selector.register(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+        self.outbuf = bytearray()
+        self.inbuf = bytearray()
+        self.answered = 0
+
+    def send(self, data):
+        if self.sock is None:
+            self.open()
+        elif not self.outbuf:
+            self.selector.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+        self.outbuf += struct.pack("!H", len(data)) + data
+
+    def write(self):
+        if self.sock is None:
+            return
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                self.drop(ex)
+                return
+            del self.outbuf[:sent]
+        if not self.outbuf:
+            self.selector.modify(self.sock, selectors.EVENT_READ, self)
+
+    def read(self):
+        if self.sock is None:
+            return []
+        error = EOFError("EOF")
+        try:
+            chunk = self.sock.recv(65535)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError as ex:
+            chunk = b""
+            error = ex
+
+        messages = []
+        self.inbuf += chunk
+        while len(self.inbuf) >= 2:
+            size = struct.unpack("!H", self.inbuf[:2])[0]
+            if len(self.inbuf) < size + 2:
+                break
+            messages.append(bytes(self.inbuf[2:size + 2]))
+            del self.inbuf[:size + 2]
+
+        if not chunk:
+            self.drop(error)
+        return messages
+
+    def drop(self, error):
+        self.close()
+        self.dropped = error
+
+    def close(self):
+        if self.sock is not None:
+            self.selector.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+
+
+class PipelinedEngine:
+    """Keep many queries in flight over a few sockets or connections per server.
+
+    A record's query is built once in wire format and sent to every server
+    under a fresh message ID. Responses are matched on (channel, ID) and on
+    the question they carry; anything else is dropped. A query with no answer
+    after `timeout` seconds is resent, and fails once `retries` resends have
+    gone unanswered.
+
+    With the udp transport, truncated answers are retried over one persistent
+    TCP connection per server rather than a new connection per answer.
+
+    When a server has a rate limiter, its queries wait in a queue of their
+    own until the limiter hands out a token, so a throttled server does not
+    hold back the others.
+    """
+
+    def __init__(self, transport, socketCount, timeout, retries):
+        self.timeout = timeout
+        self.retries = retries
+        self.selector = selectors.DefaultSelector()
+        if transport == "tcp":
+            self.channels = [[TcpChannel(self.selector, server) for _ in range(socketCount)]
+                             for server in servers]
+            self.tcpChannels = self.channels
+        else:
+            self.channels = [[UdpChannel(self.selector, server) for _ in range(socketCount)]
+                             for server in servers]
+            self.tcpChannels = [[TcpChannel(self.selector, server)] for server in servers]
+        self.sent = 0
+        self.pending = {}
+        self.deadlines = collections.deque()
+        self.limiters = [limiters.get(server) for server in servers]
+        self.queued = [collections.deque() for _ in servers]
+
+    def inflight(self):
+        return len(self.pending) + sum(len(queue) for queue in self.queued)
+
+    def submit(self, record):
+        """Send a record to every server; returns the slot its lookups are collected in."""
+        slot = {"record": record, "lookups": [None] * len(servers), "waiting": len(servers)}
+        if record[3] is not None:
+            slot["lookups"] = []
+            slot["waiting"] = 0
+            return slot
+
+        recName, recType = record[1], record[2]
+        try:
+            request = dns.message.make_query(recName, recType)
+        except Exception as ex:
+            for index, server in enumerate(servers):
+                self.finish(slot, index, failed_lookup(server, recName, recType, ex))
+            return slot
+
+        wire = request.to_wire()
+        started = time.monotonic()
+        for index in range(len(servers)):
+            self.send({"slot": slot, "index": index, "request": request, "wire": wire,
+                       "tcp": False, "tries": 1, "errors": [], "started": started})
+        return slot
+
+    def send(self, query):
+        index = query["index"]
+        limiter = self.limiters[index]
+        if limiter is not None and (self.queued[index] or not limiter.take()):
+            self.queued[index].append(query)
+            return
+        self.transmit(query)
+
+    def release(self):
+        """Transmit queued queries for which the rate limiters now have tokens."""
+        for queue, limiter in zip(self.queued, self.limiters):
+            while queue and limiter.take():
+                self.transmit(queue.popleft())
+
+    def transmit(self, query):
+        group = (self.tcpChannels if query["tcp"] else self.channels)[query["index"]]
+        channel = group[self.sent % len(group)]
+        self.sent += 1
+
+        qid = random.getrandbits(16)
+        while (channel, qid) in self.pending:
+            qid = random.getrandbits(16)
+
+        query["key"] = (channel, qid)
+        query["sent"] = time.monotonic()
+        self.pending[(channel, qid)] = query
+        self.deadlines.append((time.monotonic() + self.timeout, query, (channel, qid)))
+        channel.send(struct.pack("!H", qid) + query["wire"][2:])
+
+    def poll(self):
+        """Wait for responses (at most until the next timeout) and process them."""
+        wait = self.timeout
+        if self.deadlines:
+            wait = max(0.0, self.deadlines[0][0] - time.monotonic())
+        for queue, limiter in zip(self.queued, self.limiters):
+            if queue:
+                wait = min(wait, limiter.wait())
+
+        for key, events in self.selector.select(wait):
+            channel = key.data
+            if events & selectors.EVENT_WRITE:
+                channel.write()
+            if events & selectors.EVENT_READ:
+                for data in channel.read():
+                    self.receive(channel, data)
+            if getattr(channel, "dropped", None) is not None:
+                self.reconnect(channel)
+
+        self.expire()
+        self.release()
+
+    def reconnect(self, channel):
+        """Resend the queries that were waiting on a connection that failed.
+
+        Servers may close idle or busy connections at any time (RFC 7766), so
+        a connection that had been answering costs its queries no retry.
+        """
+        error, channel.dropped = channel.dropped, None
+        for key in [key for key in self.pending if key[0] is channel]:
+            query = self.pending.pop(key)
+            if channel.answered:
+                self.send(query)
+            else:
+                self.retry(query, error)
+
+    def receive(self, channel, data):
+        if len(data) < 12:
+            return
+        query = self.pending.get((channel, struct.unpack("!H", data[:2])[0]))
+        if query is None:
+            # Late answer to a query that was resent or has already failed
+            return
+
+        try:
+            response = dns.message.from_wire(data)
+        except Exception:
+            return
+        if not response.flags & dns.flags.QR or response.question != query["request"].question:
+            return
+
+        del self.pending[query["key"]]
+        if isinstance(channel, TcpChannel):
+            channel.answered += 1
+        if response.flags & dns.flags.TC and not query["tcp"]:
+            query["tcp"] = True
+            self.send(query)
+            return
+
+        server = servers[query["index"]]
+        limiter = self.limiters[query["index"]]
+        recName, recType = query["slot"]["record"][1], query["slot"]["record"][2]
+        latency = time.monotonic() - query["sent"]
+        try:
+            answer = answer_from_response(server, query["request"], response)
+        except Exception as ex:
+            if limiter is not None:
+                limiter.record(overloaded(ex))
+            result = failed_lookup(server, recName, recType, ex, latency)
+        else:
+            if limiter is not None:
+                limiter.record(False)
+            result = answered_lookup(answer, latency)
+        self.finish(query["slot"], query["index"], result)
+
+    def expire(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, query, key = self.deadlines.popleft()
+            if self.pending.get(key) is query:
+                del self.pending[key]
+                if self.limiters[query["index"]] is not None:
+                    self.limiters[query["index"]].record(True)
+                self.retry(query, dns.exception.Timeout())
+
+    def retry(self, query, error):
+        server = servers[query["index"]]
+        query["errors"].append((nameserver_text(server), query["tcp"], 53, error, None))
+        if query["tries"] <= self.retries:
+            query["tries"] += 1
+            self.send(query)
+            return
+
+        record = query["slot"]["record"]
+        if all(isinstance(error[3], dns.exception.Timeout) for error in query["errors"]):
+            ex = dns.resolver.LifetimeTimeout(timeout=time.monotonic() - query["started"],
+                                              errors=query["errors"])
+        else:
+            ex = dns.resolver.NoNameservers(request=query["request"], errors=query["errors"])
+        self.finish(query["slot"], query["index"],
+                    failed_lookup(server, record[1], record[2], ex, time.monotonic() - query["started"]))
+
+    def finish(self, slot, index, result):
+        slot["lookups"][index] = result
+        slot["waiting"] -= 1
+
+    def close(self):
+        for group in self.channels + (self.tcpChannels if self.tcpChannels is not self.channels else []):
+            for channel in group:
+                channel.close()
+        self.selector.close()
+
+
+def run_pipelined(records, files, concurrency, transport, socketCount, timeout, retries):
+    engine = PipelinedEngine(transport, socketCount, timeout, retries)
+    window = collections.deque()
+
+    def flush():
+        while window and window[0]["waiting"] == 0:
+            slot = window.popleft()
+            write_result(make_result(slot["record"], slot["lookups"]), files)
+
+    try:
+        for record in records:
+            window.append(engine.submit(record))
+            flush()
+            while engine.inflight() >= concurrency * len(servers) or len(window) >= concurrency * 2:
+                engine.poll()
+                flush()
+
+        while window:
+            engine.poll()
+            flush()
+    finally:
+        engine.close()
+
+
+# -------------------------
+# Zone transfers
+# -------------------------
+def read_zones(inputFile):
+    """Yield (lineNumber, zone) for every zone listed in an --axfr input file."""
+    with open(inputFile, "r", newline="") as zonesFile:
+        for i, line in enumerate(csv.reader(zonesFile), 1):
             if not line or line[0].strip() == "" or line[0].startswith("#"):
                 continue
+            yield i, line[0].strip()
+
+
+# Longest a whole zone transfer may take, however steadily the messages arrive
+TRANSFER_LIFETIME = 3600.0
+
+
+def transfer_zone(server, zoneName):
+    return dns.zone.from_xfr(dns.query.xfr(server, zoneName, relativize=False, timeout=transferTimeout,
+                                           lifetime=TRANSFER_LIFETIME), relativize=False)
+
+
+class ZoneCache:
+    """Every server's last copy of each zone, kept in a directory for --ixfr-cache.
+
+    DIR/<zone>/<server>.zone holds the copies and DIR/<zone>/state.json the
+    names that did not compare identical last time. A cached copy is updated
+    by IXFR; the copy-on-write transaction replaces exactly the nodes the
+    deltas touch, so comparing node identities before and after tells which
+    names changed. A full transfer in reply replaces every node.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
 
-            spin(spinner)
-            print("", file=logfile)
+    def path(self, zoneName, filename):
+        return os.path.join(self.directory, zoneName.rstrip(".").lower(), filename)
 
+    def transfer(self, server, zoneName):
+        """Return (zone, names changed since the cached copy, or None if there was none)."""
+        path = self.path(zoneName, f"{server}.zone")
+        if os.path.exists(path):
+            zone = dns.zone.from_file(path, zoneName, relativize=False)
+            before = dict(zone.nodes)
             try:
-                recName = line[0].strip()
-                recType = line[1].strip()
-            except Exception as exIndex:
-                lineNumber = i + 1
-                sys.stdout.write('\b')
-                msg = f"Ignoring bad data at line {lineNumber}: \"{exIndex}\""
-                print(msg)
-                print(msg, file=logfile)
-                print(msg, file=exceptionLog)
+                dns.query.inbound_xfr(server, zone, dns.xfr.make_query(zone)[0], timeout=transferTimeout,
+                                      lifetime=TRANSFER_LIFETIME)
+            except dns.exception.Timeout:
+                # A full transfer would only time out as well
+                raise
+            except dns.exception.DNSException:
+                # e.g. the serial went backwards or IXFR is refused: start afresh
+                return transfer_zone(server, zoneName), None
+            changed = {name for name in before.keys() | zone.nodes.keys()
+                       if before.get(name) is not zone.nodes.get(name)}
+            return zone, changed
+        return transfer_zone(server, zoneName), None
+
+    def recheck(self, zoneName):
+        """Return the names that did not compare identical last time, or None if there is no state."""
+        try:
+            with open(self.path(zoneName, "state.json"), "r") as stateFile:
+                return {dns.name.from_text(name) for name in json.load(stateFile)["recheck"]}
+        except FileNotFoundError:
+            return None
+
+    def save(self, zoneName, zones, recheck):
+        os.makedirs(self.path(zoneName, ""), exist_ok=True)
+        for server, zone in zip(servers, zones):
+            path = self.path(zoneName, f"{server}.zone")
+            zone.to_file(path + ".tmp", relativize=False)
+            os.replace(path + ".tmp", path)
+        path = self.path(zoneName, "state.json")
+        with open(path + ".tmp", "w") as stateFile:
+            json.dump({"recheck": sorted(name.to_text() for name in recheck)}, stateFile)
+        os.replace(path + ".tmp", path)
+
+
+def load_zone_file(path, zoneName):
+    """Load a zone from a zone file, or from the file for it in a directory of zone files."""
+    if os.path.isdir(path):
+        bare = zoneName.rstrip(".")
+        for filename in (bare, f"{bare}.zone", f"{bare}.db", f"db.{bare}"):
+            if os.path.isfile(os.path.join(path, filename)):
+                path = os.path.join(path, filename)
+                break
+        else:
+            raise FileNotFoundError(f"no zone file for {bare} in {path}")
+    return dns.zone.from_file(path, zoneName, relativize=False)
+
+
+def zone_results(lineNumber, zoneName, transfers, unchanged=frozenset(), kind="AXFR"):
+    """Compare the copies of one zone, yielding a result per name and type in zone order.
+
+    transfers holds each server's dns.zone.Zone, or the exception that
+    stopped its transfer; a zone that could not be transferred from every
+    server is reported as a single row of type `kind`. Names in `unchanged` are passed on
+    as UNCHANGED without comparing them.
+    """
+    failed = [(server, zone) for server, zone in zip(servers, transfers) if isinstance(zone, Exception)]
+    if failed:
+        lookups = [failed_lookup(server, zoneName, kind, zone) if isinstance(zone, Exception)
+                   else (CanonicalAnswer(text=[f"transferred, {len(zone.nodes)} names"]), None)
+                   for server, zone in zip(servers, transfers)]
+        yield make_result((lineNumber, zoneName, kind, None), lookups)
+        return
+
+    names = sorted(set().union(*(zone.nodes.keys() for zone in transfers)))
+    for name in names:
+        nodes = [zone.get_node(name) for zone in transfers]
+        rdtypes = sorted({(rdataset.rdtype, rdataset.covers) for node in nodes if node is not None
+                          for rdataset in node.rdatasets})
+        for rdtype, covers in rdtypes:
+            # An RRSIG set per covered type, told apart as e.g. RRSIG(A)
+            typeText = dns.rdatatype.to_text(rdtype)
+            if covers != dns.rdatatype.NONE:
+                typeText += f"({dns.rdatatype.to_text(covers)})"
+            record = (lineNumber, name.to_text(omit_final_dot=True), typeText, None)
+            if name in unchanged:
+                yield make_result(record[:3] + (UNCHANGED,), [])
                 continue
+            lookups = []
+            for node in nodes:
+                rdataset = node.get_rdataset(dns.rdataclass.IN, rdtype, covers) if node is not None else None
+                lookups.append((CanonicalAnswer(rdataset) if rdataset is not None else CanonicalAnswer(text=[]), None))
+            yield make_result(record, lookups)
+
+
+def run_zones(inputFile, files, cache=None, window=4, load=transfer_zone, kind="AXFR"):
+    """Compare whole zones from every server (or zone file), a few zones at a time.
+
+    load(server, zone) fetches one copy of a zone, by default by AXFR. Only
+    `window` zones are held in memory (once per server); results are
+    written zone by zone in the order the zones are listed. With a ZoneCache
+    the zones are updated by IXFR and only changed names compared.
+    """
+    def transfer(server, zoneName):
+        try:
+            if cache is not None:
+                return cache.transfer(server, zoneName)
+            return load(server, zoneName), None
+        except Exception as ex:
+            return ex, None
+
+    def compare_zone(lineNumber, zoneName, futures):
+        transfers, changes = zip(*[future.result() for future in futures])
+        unchanged = frozenset()
+        recheck = cache.recheck(zoneName) if cache is not None else None
+        if recheck is not None and None not in changes:
+            unchanged = set().union(*(zone.nodes.keys() for zone in transfers)) - recheck
+            unchanged = unchanged.difference(*changes)
+
+        recheck = set()
+        for result in zone_results(lineNumber, zoneName, transfers, unchanged, kind):
+            if result["unchanged"] is None and (result["exceptions"]
+                                            or disagreeing_servers(result["answers"], result["type"])):
+                recheck.add(dns.name.from_text(result["name"]))
+            write_result(result, files)
+        if cache is not None and not any(isinstance(zone, Exception) for zone in transfers):
+            cache.save(zoneName, transfers, recheck)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=window * len(servers)) as executor:
+        pending = collections.deque()
+        for lineNumber, zoneName in read_zones(inputFile):
+            pending.append((lineNumber, zoneName,
+                            [executor.submit(transfer, server, zoneName) for server in servers]))
+            if len(pending) >= window:
+                compare_zone(*pending.popleft())
+
+        while pending:
+            compare_zone(*pending.popleft())
+
+
+# -------------------------
+# Output
+# -------------------------
+# --log-level: what goes into the main log besides its header
+LOG_SUMMARY, LOG_MISMATCHES, LOG_FULL = range(3)
+LOG_LEVELS = {"summary": LOG_SUMMARY, "mismatches": LOG_MISMATCHES, "full": LOG_FULL}
+
+
+def write_json(files, result, verdict, answers=None, disagree=(), same=False):
+    """Append a result to the JSON Lines file, if the run writes one.
+
+    same says every answer is equal, so their one text can be shared.
+    """
+    results = files.get("results")
+    if results is None:
+        return
+
+    entry = {"line": result["line"], "name": result["name"], "type": result["type"], "verdict": verdict}
+    if result["bad"] is not None:
+        entry["error"] = str(result["bad"])
+    if result["duplicate"] is not None:
+        entry["duplicate_of"] = result["duplicate"]
+    if answers:
+        # Identical answers have the same text, so it is rendered only once
+        texts = [answers[0].text] * len(answers) if same else [answer.text for answer in answers]
+        entry["servers"] = [
+            {"server": server, "answer": text, "rcode": answer.rcode,
+             "latency": round(answer.latency, 6) if answer.latency is not None else None}
+            for server, answer, text in zip(servers, answers, texts)
+        ]
+    if disagree:
+        entry["disagree"] = [servers[i] for i in disagree]
+    results.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+def write_result(result, files):
+    global loopCount, exceptionCount, mismatchCount, unchangedCount, duplicateCount
+
+    loopCount += 1
+    log = files["log"]
+
+    recName = result["name"]
+    recType = result["type"]
+
+    if result["bad"] is not None:
+        msg = f"Ignoring bad data at line {result['line']}: \"{result['bad']}\""
+        progress.message(msg)
+        if logLevel >= LOG_MISMATCHES:
+            print("", file=log)
+            print(msg, file=log)
+        print(msg, file=files["exceptions"])
+        write_json(files, result, "bad")
+        if journal is not None:
+            journal.advance(result["line"])
+        return
+
+    if result["duplicate"] is not None:
+        duplicateCount += 1
+        if logLevel >= LOG_FULL:
+            print("", file=log)
+            print(f"{recName} {recType}: duplicate of line {result['duplicate']}, not queried", file=log)
+        write_json(files, result, "duplicate")
+        if journal is not None:
+            journal.advance(result["line"])
+        return
+
+    if result["unchanged"] is not None:
+        unchangedCount += 1
+        if logLevel >= LOG_FULL:
+            print("", file=log)
+            print(f"{recName} {recType}: OK identical ({result['unchanged']})", file=log)
+        print(f"{recName}", file=files["identical"])
+        write_json(files, result, "unchanged")
+        if journal is not None:
+            journal.advance(result["line"])
+        return
+
+    for msg in result["exceptions"]:
+        exceptionCount += 1
+        print(msg, file=files["exceptions"])
+
+    answers = result["answers"]
+
+    # Compare answers
+    disagree = disagreeing_servers(answers, recType)
+    # Without a disagreement the answers may still differ where --rules let them agree
+    same = not disagree and all(answer == answers[0] for answer in answers[1:])
+    if disagree:
+        mismatchCount += 1
+        detail = ""
+        if len(servers) > 2:
+            detail = f" ({', '.join(servers[i] for i in disagree)} disagree)"
+        for i in disagree:
+            disagreeCounts[i] += 1
+
+        if logLevel >= LOG_MISMATCHES:
+            print("", file=log)
+            print(f"{recName} {recType}: mismatch{detail}", file=log)
+        print(f"{recName} {recType}:{detail}", file=files["errors"])
+        for server, answer in zip(servers, answers):
+            print(f"    {server:>16}: {answer.text}", file=files["errors"])
+        print(f"{recName},{recType}", file=files["problems"])
+    else:
+        if logLevel >= LOG_FULL:
+            print("", file=log)
+            verdict = "OK identical" if same else "OK, failed alike" if result["exceptions"] else "OK, agrees by rule"
+            print(f"{recName} {recType}: {verdict}", file=log)
+        print(f"{recName}", file=files["identical"])
+
+    # Log raw responses (identical answers have the same text, so render it once)
+    if logLevel >= LOG_FULL or (disagree and logLevel >= LOG_MISMATCHES):
+        logged = [answers[0]] * len(servers) if same else answers
+        for server, answer in zip(servers, logged):
+            print(f"    {server:>16}: {answer.text}", file=log)
+
+    for serverStats, answer in zip(stats, answers):
+        if answer.latency is not None:
+            serverStats.record(answer)
+
+    verdict = "mismatch" if disagree else "error" if result["exceptions"] else "identical"
+    write_json(files, result, verdict, answers, disagree, same)
+    if store is not None:
+        store.record(recName, recType, verdict, answers, zones.serials_for(recName))
+    if journal is not None:
+        journal.advance(result["line"])
+
+
+# -------------------------
+# Statistics
+# -------------------------
+class ServerStats:
+    """Latency histogram and response counters for one server.
+
+    Latencies go into fixed buckets (upper bounds in LATENCY_BUCKETS, in
+    milliseconds, plus one for anything slower), so recording a lookup costs
+    the same however long the run. Percentiles are reported as the upper
+    bound of the bucket they fall in.
+    """
+
+    LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self, state=None):
+        self.latencies = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.rcodes = collections.Counter()
+        self.exceptions = collections.Counter()
+        self.timeouts = 0
+        if state is not None:
+            self.latencies = list(state["latency_counts"])
+            self.rcodes.update(state["rcodes"])
+            self.exceptions.update(state["exceptions"])
+            self.timeouts = state["timeouts"]
+
+    def record(self, answer):
+        self.latencies[bisect.bisect_left(self.LATENCY_BUCKETS, answer.latency * 1000.0)] += 1
+        if answer.rcode is not None:
+            self.rcodes[answer.rcode] += 1
+        if answer.error is not None:
+            self.exceptions[type(answer.error).__name__] += 1
+            if isinstance(answer.error, dns.exception.Timeout):
+                self.timeouts += 1
+
+    def merge(self, other):
+        self.latencies = [a + b for a, b in zip(self.latencies, other.latencies)]
+        self.rcodes.update(other.rcodes)
+        self.exceptions.update(other.exceptions)
+        self.timeouts += other.timeouts
+
+    def percentile(self, fraction):
+        """Return the bucket bound (ms) below which `fraction` of the lookups fell, or None."""
+        total = sum(self.latencies)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.LATENCY_BUCKETS + [None], self.latencies):
+            seen += count
+            if seen >= fraction * total:
+                return bound
 
-            # Lookup in resolver 1
+    def state(self):
+        """The counters as JSON-friendly data, for checkpoints and the stats file."""
+        return {
+            "queries": sum(self.latencies),
+            "latency_buckets_ms": self.LATENCY_BUCKETS,
+            "latency_counts": self.latencies,
+            "p50_ms": self.percentile(0.50),
+            "p90_ms": self.percentile(0.90),
+            "p99_ms": self.percentile(0.99),
+            "timeouts": self.timeouts,
+            "rcodes": dict(self.rcodes),
+            "exceptions": dict(self.exceptions),
+        }
+
+    def summary(self):
+        def bound(fraction):
+            value = self.percentile(fraction)
+            return f"<={value} ms" if value is not None else f">{self.LATENCY_BUCKETS[-1]} ms"
+
+        if not sum(self.latencies):
+            return "no queries"
+        text = f"p50 {bound(0.50)}, p90 {bound(0.90)}, p99 {bound(0.99)}, {self.timeouts} timeouts"
+        if self.rcodes:
+            text += ", " + ", ".join(f"{rcode} {count}" for rcode, count in self.rcodes.most_common())
+        return text
+
+
+def write_stats(filename):
+    with open(filename, "w") as statsFile:
+        json.dump({"servers": {server: serverStats.state() for server, serverStats in zip(servers, stats)}},
+                  statsFile, indent=2)
+        statsFile.write("\n")
+
+
+# -------------------------
+# Metrics export
+# -------------------------
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsExporter:
+    """Keeps a Prometheus text-format file (for node_exporter's textfile collector) up to date.
+
+    The file is rewritten every `interval` seconds by a background thread and
+    once more when the run stops, always through a temporary file renamed
+    over it, so the collector never reads half a file. startTime is when the
+    run began (time.time()), before any pre-pass. counts, when set,
+    returns (tested, mismatched, exceptions) in place of the module counters.
+    """
+
+    def __init__(self, filename, startTime, interval=15.0):
+        self.filename = filename
+        self.interval = interval
+        self.counts = None
+        self.startTime = startTime
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.write(finished=False)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
             try:
-                a1 = res1.resolve(recName, recType)
-            except Exception as ex1:
-                exceptionCount += 1
-                print(f"Exception from {ip1}: {recName} {recType}: \"{ex1}\"", file=exceptionLog)
-                a1 = [f"bad response \"{ex1}\""]
+                self.write(finished=False)
+            except (OSError, RuntimeError):
+                # RuntimeError: a counter grew while being read; next time will do
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write(finished=True)
+
+    def render(self, finished):
+        tested, mismatched, exceptions = self.counts() if self.counts is not None \
+            else (loopCount, mismatchCount, exceptionCount)
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP compare_dns_{name} {help}")
+            lines.append(f"# TYPE compare_dns_{name} {kind}")
+            for labels, value in samples:
+                labelText = ",".join(f'{key}="{prometheus_label(label)}"' for key, label in labels)
+                lines.append(f"compare_dns_{name}{{{labelText}}} {value}" if labelText
+                             else f"compare_dns_{name} {value}")
+
+        metric("records_tested", "gauge", "Records compared so far in the run.", [((), tested)])
+        metric("mismatches", "gauge", "Records on which the servers disagreed.", [((), mismatched)])
+        metric("exceptions", "gauge", "Lookups that failed.", [((), exceptions)])
+        metric("run_start_timestamp_seconds", "gauge", "When the run started.", [((), f"{self.startTime:.3f}")])
+        metric("run_duration_seconds", "gauge", "How long the run has taken so far.",
+               [((), f"{time.time() - self.startTime:.3f}")])
+        metric("run_finished", "gauge", "1 once the run has completed.", [((), int(finished))])
+
+        quantiles, timeouts, rcodes = [], [], []
+        for server, serverStats in zip(servers, stats):
+            for fraction in (0.5, 0.9, 0.99):
+                if sum(serverStats.latencies):
+                    bound = serverStats.percentile(fraction)
+                    value = bound / 1000.0 if bound is not None else "+Inf"
+                    quantiles.append(((("server", server), ("quantile", fraction)), value))
+            timeouts.append(((("server", server),), serverStats.timeouts))
+            for rcode, count in sorted(serverStats.rcodes.items()):
+                rcodes.append(((("server", server), ("rcode", rcode)), count))
+        metric("lookup_latency_seconds", "gauge",
+               "Lookup latency quantiles per server (upper bound of the histogram bucket).", quantiles)
+        metric("timeouts", "gauge", "Lookups per server that timed out.", timeouts)
+        metric("responses", "gauge", "Responses per server by response code.", rcodes)
+        return "\n".join(lines) + "\n"
+
+    def write(self, finished):
+        temporary = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temporary, "w") as metricsFile:
+            metricsFile.write(self.render(finished))
+        os.replace(temporary, self.filename)
+
+
+# -------------------------
+# Checkpoints
+# -------------------------
+class Journal:
+    """Append-only record of how far a run has got, read back by --resume.
+
+    The first line describes the run. After that, every `interval` seconds the
+    output files are flushed and synced and one JSON line is appended with the
+    last input line written, each output file's size and the counters. Results
+    are always written in input order, so the latest line is all a resumed run
+    needs: it cuts the outputs back to those sizes and carries on from the
+    next input line.
+    """
+
+    def __init__(self, filename, files, interval=5.0, extra=None):
+        self.files = files
+        self.interval = interval
+        self.extra = extra or {}
+        self.journal = open(filename, "a")
+        self.lastLine = 0
+        self.unchecked = 0
+        self.due = time.monotonic() + interval
+
+    @staticmethod
+    def load(filename):
+        """Return the run description and the latest checkpoint, ignoring a torn last line."""
+        header, latest = None, None
+        with open(filename, "r") as journalFile:
+            for line in journalFile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if header is None:
+                    header = entry
+                else:
+                    latest = entry
+        return header, latest
+
+    def describe(self, args):
+        self.write({"servers": args.servers, "input": os.path.abspath(args.input_csv),
+                    "processes": args.processes, "jsonl": args.jsonl, "compress": args.compress,
+                    **self.extra})
+
+    def restore(self, entry):
+        """Set the counters from a checkpoint, before output files are reopened with truncate()."""
+        global loopCount, exceptionCount, mismatchCount, disagreeCounts, unchangedCount, duplicateCount, stats
+
+        self.lastLine = entry["line"]
+        loopCount = entry["tested"]
+        mismatchCount = entry["mismatched"]
+        exceptionCount = entry["exceptions"]
+        disagreeCounts = entry["disagree"]
+        unchangedCount = entry.get("unchanged", 0)
+        duplicateCount = entry.get("duplicates", 0)
+        if "stats" in entry:
+            stats = [ServerStats(state) for state in entry["stats"]]
+
+    @staticmethod
+    def truncate(entry, filenames):
+        for kind, filename in filenames.items():
+            with open(filename, "r+b") as outputFile:
+                outputFile.truncate(entry["sizes"][kind])
+
+    def advance(self, lineNumber):
+        self.lastLine = lineNumber
+        self.unchecked += 1
+        # Only look at the clock now and then; this runs once per record.
+        if self.unchecked >= 256:
+            self.unchecked = 0
+            if time.monotonic() >= self.due:
+                self.checkpoint()
+
+    def checkpoint(self):
+        sizes = {}
+        for kind, outputFile in self.files.items():
+            outputFile.flush()
+            os.fsync(outputFile.fileno())
+            sizes[kind] = os.fstat(outputFile.fileno()).st_size
+
+        self.write({
+            "line": self.lastLine,
+            "sizes": sizes,
+            "tested": loopCount,
+            "mismatched": mismatchCount,
+            "exceptions": exceptionCount,
+            "disagree": disagreeCounts,
+            "unchanged": unchangedCount,
+            "duplicates": duplicateCount,
+            "stats": [serverStats.state() for serverStats in stats],
+            **self.extra,
+        })
+        self.due = time.monotonic() + self.interval
+
+    def write(self, entry):
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def close(self):
+        self.journal.close()
+
+
+def check_resumable(header, args, journalFilename):
+    """Exit with a message if the journal belongs to a run with different settings."""
+    if header is None:
+        sys.exit(f"Cannot resume: {journalFilename} is empty")
+    if header["servers"] != args.servers or header["input"] != os.path.abspath(args.input_csv):
+        sys.exit(f"Cannot resume: {journalFilename} was written for {header['servers']} "
+                 f"comparing {header['input']}")
+    if header["processes"] != args.processes:
+        sys.exit(f"Cannot resume: the run used --processes {header['processes']}")
+    if header.get("compress") is not None:
+        sys.exit(f"Cannot resume: the run wrote --compress {header['compress']} output, "
+                 f"which cannot be cut back to a checkpoint")
+    if header.get("jsonl", True) != args.jsonl:
+        sys.exit("Cannot resume: the run was started " + ("with" if args.jsonl else "without")
+                 + " --no-jsonl; resume it the same way")
+
+
+def resume_records(records, entry):
+    """Skip the records a resumed run has already written."""
+    if entry is None:
+        return records
+    return (record for record in records if record[0] > entry["line"])
+
+
+# -------------------------
+# Incremental runs and --trust-soa
+# -------------------------
+# Mark a record that --incremental or --trust-soa will not query (in place of badData)
+UNCHANGED = object()
+IN_SYNC = object()
+SKIP_REASONS = {UNCHANGED: "unchanged since last run, not queried", IN_SYNC: "zone serial in sync, not queried"}
+
+
+class ResultStore:
+    """Latest result of every (fqdn, type) compared, kept in SQLite for --incremental.
+
+    Each row holds the verdict, a digest of every server's answer and the
+    SOA serials the record's zone had on every server when it was compared.
+    Writes are batched; several worker processes may share one file.
+    """
+
+    BATCH = 1000
+
+    def __init__(self, filename, run):
+        self.run = run
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "name TEXT, type TEXT, verdict TEXT, digests TEXT, serials TEXT, run TEXT, "
+                        "PRIMARY KEY (name, type))")
+        self.db.commit()
+        self.batch = []
+
+    def previous(self, recName, recType):
+        """Return (verdict, serials) from the last time the record was compared, or None."""
+        row = self.db.execute("SELECT verdict, serials FROM results WHERE name = ? AND type = ?",
+                              (canonical_name(recName), recType.upper())).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def record(self, recName, recType, verdict, answers, serials):
+        digests = [answer.digest() for answer in answers]
+        self.batch.append((canonical_name(recName), recType.upper(), verdict,
+                           json.dumps(digests), json.dumps(serials), self.run))
+        if len(self.batch) >= self.BATCH:
+            self.flush()
 
-            answer1 = sorted([str(a).lower() for a in a1])
+    def flush(self):
+        if self.batch:
+            self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", self.batch)
+            self.db.commit()
+            self.batch = []
 
-            # Lookup in resolver 2
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def soa_probe(server, name):
+    """Ask a server for the SOA of `name`; return (zone, serial) or None.
+
+    Like dns.resolver.zone_for_name(), the zone is taken from the answer when
+    `name` is a zone apex, else from the SOA in the authority section.
+    """
+    try:
+        qname = dns.name.from_text(name)
+        response, _ = dns.query.udp_with_fallback(dns.message.make_query(qname, "SOA"), server, timeout=2.0)
+    except Exception:
+        return None
+
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.SOA and rrset.name == qname:
+            return name, rrset[0].serial
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA and qname.is_subdomain(rrset.name):
+            return canonical_name(rrset.name.to_text()), rrset[0].serial
+    return None
+
+
+def zonemd_probe(server, zone):
+    """Return a server's ZONEMD records for a zone as sorted text ([] if it has none), or None."""
+    try:
+        response, _ = dns.query.udp_with_fallback(dns.message.make_query(zone, "ZONEMD"), server, timeout=2.0)
+    except Exception:
+        return None
+    if response.rcode() != dns.rcode.NOERROR:
+        return None
+    return sorted(str(rdata) for rrset in response.answer if rrset.rdtype == dns.rdatatype.ZONEMD
+                  for rdata in rrset)
+
+
+class ZoneSerials:
+    """The zone each CSV name is in, and that zone's SOA serial on every server.
+
+    Zones are found on the first server with one SOA query per distinct parent
+    name, so a name is assumed to be in the same zone as its siblings (the
+    apex of a delegated child zone is only recognised if it was the name
+    probed). Serials are then fetched once per zone per server, and with
+    digests=True the zone's ZONEMD records as well.
+    """
+
+    def __init__(self):
+        self.parentZones = {}
+        self.apexes = set()
+        self.serials = {}
+        self.synced = set()
+
+    def zone_of(self, name):
+        name = canonical_name(name)
+        if name in self.apexes:
+            return name
+        return self.parentZones.get(name.partition(".")[2])
+
+    def serials_for(self, name):
+        """Return the per-server serials of the name's zone, or None if any is unknown."""
+        zone = self.zone_of(name)
+        return self.serials.get(zone) if zone is not None else None
+
+    def in_sync(self, name):
+        """Whether the name's zone has the same serial (and digest) on every server."""
+        return self.zone_of(name) in self.synced
+
+    def discover(self, inputCsv, digests=False, workers=32):
+        samples = {}
+        for record in read_records(inputCsv):
+            if record[3] is None:
+                name = canonical_name(record[1])
+                samples.setdefault(name.partition(".")[2], name)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            found = dict(zip(samples, pool.map(lambda name: soa_probe(servers[0], name), samples.values())))
+
+            # A probed name that turned out to be a zone apex says nothing about
+            # its siblings, so look up the parent itself for them.
+            apexParents = []
+            for parent, probe in found.items():
+                if probe is not None and probe[0] == samples[parent]:
+                    self.apexes.add(probe[0])
+                    apexParents.append(parent)
+                elif probe is not None:
+                    self.parentZones[parent] = probe[0]
+            for parent, probe in zip(apexParents, pool.map(lambda name: soa_probe(servers[0], name),
+                                                            apexParents)):
+                if probe is not None:
+                    self.parentZones[parent] = probe[0]
+
+            zoneList = sorted(set(self.parentZones.values()) | self.apexes)
+            probes = pool.map(lambda job: soa_probe(job[1], job[0]),
+                              [(zone, server) for zone in zoneList for server in servers])
+            probes = list(probes)
+            if digests:
+                zonemds = list(pool.map(lambda job: zonemd_probe(job[1], job[0]),
+                                        [(zone, server) for zone in zoneList for server in servers]))
+
+        for i, zone in enumerate(zoneList):
+            serials = [probe[1] if probe is not None and probe[0] == zone else None
+                       for probe in probes[i * len(servers):(i + 1) * len(servers)]]
+            if None not in serials:
+                self.serials[zone] = serials
+                if len(set(serials)) == 1:
+                    if not digests:
+                        self.synced.add(zone)
+                    else:
+                        zoneDigests = zonemds[i * len(servers):(i + 1) * len(servers)]
+                        if None not in zoneDigests and all(d == zoneDigests[0] for d in zoneDigests):
+                            self.synced.add(zone)
+
+
+def skip_records(records, trustSoa):
+    """Mark the records that need no queries as IN_SYNC (--trust-soa) or UNCHANGED (--incremental)."""
+    for record in records:
+        if record[3] is None:
+            if trustSoa and zones.in_sync(record[1]):
+                record = (record[0], record[1], record[2], IN_SYNC)
+            elif store is not None:
+                previous = store.previous(record[1], record[2])
+                if previous is not None and previous[0] == "identical" \
+                        and previous[1] is not None and previous[1] == zones.serials_for(record[1]):
+                    record = (record[0], record[1], record[2], UNCHANGED)
+        yield record
+
+
+# -------------------------
+# Setup
+# -------------------------
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def configure(args, share=1):
+    """Set the module-level settings the engines use (worker processes call this too).
+
+    share divides --qps and --max-qps between that many worker processes.
+    """
+    global servers, referenceIndex, limiters, comparators, logLevel, transferTimeout
+
+    servers = args.servers
+    transferTimeout = args.timeout
+    referenceIndex = servers.index(args.reference) if args.reference is not None else None
+    comparators = load_rules(args.rules) if args.rules is not None else {}
+    logLevel = LOG_LEVELS[args.log_level]
+
+    limiters = {}
+    if args.qps is not None or args.adaptive:
+        ceiling = args.max_qps / share if args.max_qps is not None else None
+        for server in servers:
+            limiters[server] = RateLimiter((args.qps or 100) / share, args.adaptive, ceiling)
+
+
+def reset_counters():
+    global loopCount, exceptionCount, mismatchCount, disagreeCounts, unchangedCount, duplicateCount, stats
+
+    loopCount = 0
+    exceptionCount = 0
+    mismatchCount = 0
+    disagreeCounts = [0] * len(servers)
+    unchangedCount = 0
+    duplicateCount = 0
+    stats = [ServerStats() for _ in servers]
+
+
+def output_filenames(prefix, compress=None, jsonl=True):
+    suffix = COMPRESSED_SUFFIXES[compress] if compress is not None else ""
+    filenames = {
+        "log": f"{prefix}_compare-dns.log{suffix}",
+        "identical": f"{prefix}_identical.txt{suffix}",
+        "problems": f"{prefix}_problems.csv{suffix}",
+        "errors": f"{prefix}_compare-dns.errors{suffix}",
+        "exceptions": f"{prefix}_compare-dns.exceptions{suffix}",
+    }
+    if jsonl:
+        filenames["results"] = f"{prefix}_results.jsonl{suffix}"
+    return filenames
+
+
+class QueuedFile:
+    """Output file whose write() only queues the text for its OutputWriter."""
+
+    def __init__(self, stream, writer):
+        self.stream = stream
+        self.writer = writer
+        self.chunks = []
+
+    def write(self, text):
+        writer = self.writer
+        with writer.lock:
+            # Past the limit, wait for the writer thread instead of queueing without bound
+            while writer.queued >= writer.limit and writer.error is None and writer.thread.is_alive():
+                writer.wake.set()
+                writer.room.wait(writer.interval)
+            self.chunks.append(text)
+            writer.queued += len(text)
+            if writer.queued >= writer.threshold:
+                writer.wake.set()
+
+    def flush(self):
+        self.writer.drain()
+        self.stream.flush()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+
+class OutputWriter:
+    """Writes the output files from a thread of its own, so results never wait on file I/O.
+
+    Lines written to its QueuedFiles pile up in memory until `threshold`
+    characters are waiting or `interval` seconds have passed, then the
+    thread writes each file's share in one go. Once four times `threshold`
+    is waiting, write() blocks until the thread has caught up, so a slow
+    disk or compressor holds back the results rather than filling memory.
+    flush() on a file, and leaving the writer's context, write out
+    everything queued.
+    """
+
+    def __init__(self, threshold=1 << 20, interval=1.0):
+        self.threshold = threshold
+        self.limit = 4 * threshold
+        self.interval = interval
+        self.files = []
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        # Held while writing, so text reaches every file in the order it was queued
+        self.ioLock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def add(self, stream):
+        queued = QueuedFile(stream, self)
+        self.files.append(queued)
+        return queued
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+        self.drain()
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait(self.interval)
+            self.wake.clear()
             try:
-                a2 = res2.resolve(recName, recType)
-            except Exception as ex2:
-                exceptionCount += 1
-                print(f"Exception from {ip2}: {recName} {recType}: \"{ex2}\"", file=exceptionLog)
-                a2 = [f"bad response \"{ex2}\""]
-
-            answer2 = sorted([str(a).lower() for a in a2])
-
-            # Compare answers
-            if answer1 != answer2:
-                mismatchCount += 1
-                print(f"{recName} {recType}: mismatch", file=logfile)
-                print(f"{recName} {recType}:", file=errlogfile)
-                print(f"    {ip1[0]:>16}: {answer1}", file=errlogfile)
-                print(f"    {ip2[0]:>16}: {answer2}", file=errlogfile)
-                print(f"{recName},{recType}", file=problemsFile)
+                self.drain()
+            except OSError as ex:
+                with self.lock:
+                    self.error = ex
+                    self.room.notify_all()
+                return
+
+    def drain(self):
+        if self.error is not None:
+            raise self.error
+        with self.ioLock:
+            with self.lock:
+                batches = [(queued.stream, queued.chunks) for queued in self.files if queued.chunks]
+                for queued in self.files:
+                    queued.chunks = []
+                self.queued = 0
+                self.room.notify_all()
+            for stream, chunks in batches:
+                stream.write("".join(chunks))
+
+
+def open_output(filename, mode, compress=None, level=None):
+    """Open one output file for text, through a streaming compressor if asked to."""
+    if compress == "gzip":
+        return gzip.open(filename, mode + "t", compresslevel=level if level is not None else 6)
+    if compress == "zstd":
+        import zstandard
+        return zstandard.open(filename, mode + "t",
+                              cctx=zstandard.ZstdCompressor(level=level if level is not None else 3))
+    return open(filename, mode)
+
+
+def open_outputs(stack, filenames, mode="w", compress=None, level=None):
+    """Open every output file on an ExitStack, returning them keyed like `filenames`.
+
+    The files are written through an OutputWriter, which is flushed before
+    the files are closed.
+    """
+    streams = {kind: stack.enter_context(open_output(filename, mode, compress, level))
+               for kind, filename in filenames.items()}
+    writer = stack.enter_context(OutputWriter())
+    return {kind: writer.add(stream) for kind, stream in streams.items()}
+
+
+def run_engine(args, records, files):
+    if store is not None or args.trust_soa:
+        records = skip_records(records, args.trust_soa)
+    if args.engine == 'asyncio':
+        asyncio.run(run_asyncio(records, files, args.concurrency))
+    elif args.engine == 'threads':
+        run_threads(records, files, args.workers)
+    elif args.engine == 'pipelined':
+        run_pipelined(records, files, args.concurrency, args.transport,
+                      args.sockets, args.timeout, args.retries)
+    else:
+        run_sequential(records, files)
+
+
+# -------------------------
+# Multi-process sharding
+# -------------------------
+def shard_ranges(inputCsv, count):
+    """Split the CSV into at most `count` byte ranges that start on line boundaries.
+
+    Returns (start, end, firstLine) tuples, firstLine being the line number of
+    the first line in the range.
+    """
+    size = os.path.getsize(inputCsv)
+    starts = [(0, 1)]
+    with open(inputCsv, "rb") as csvfile:
+        lineNumber = 1
+        for k in range(1, count):
+            target = size * k // count
+            while csvfile.tell() < target:
+                lineNumber += csvfile.read(min(1 << 20, target - csvfile.tell())).count(b"\n")
+            # Move on to the start of the next line
+            if csvfile.readline().endswith(b"\n"):
+                lineNumber += 1
+            if csvfile.tell() >= size:
+                break
+            if csvfile.tell() > starts[-1][0]:
+                starts.append((csvfile.tell(), lineNumber))
+
+    ends = [start for start, _ in starts[1:]] + [size]
+    return [(start, end, firstLine) for (start, firstLine), end in zip(starts, ends)]
+
+
+def init_shard_worker(counts):
+    global shardCounts
+    shardCounts = counts
+
+
+def run_shard(args, zoneSerials, run, shardIndex, start, end, firstLine, prefix):
+    """Compare one byte range of the CSV in a worker process, writing to its own output files.
+
+    The tested and mismatched counts are published to the parent's progress
+    line (and --prometheus) through the shared shardCounts array every half second. Each shard
+    keeps its own journal, so --resume carries on every shard separately.
+    """
+    global progress, journal, store, zones
+
+    configure(args, share=args.processes)
+    reset_counters()
+    progress = Progress(None, enabled=False)
+    zones = zoneSerials
+    store = ResultStore(args.incremental, run) if args.incremental else None
+
+    filenames = output_filenames(prefix, jsonl=args.jsonl)
+    journalFilename = f"{prefix}_compare-dns.journal"
+    entry = None
+    if args.resume and os.path.exists(journalFilename):
+        _, entry = Journal.load(journalFilename)
+    if entry is not None and entry["range"] != [start, end]:
+        raise RuntimeError(f"{journalFilename} covers a different part of the CSV")
+
+    stopped = threading.Event()
+
+    def publish():
+        while not stopped.wait(0.5):
+            shardCounts[3 * shardIndex] = loopCount
+            shardCounts[3 * shardIndex + 1] = mismatchCount
+            shardCounts[3 * shardIndex + 2] = exceptionCount
+
+    reporter = threading.Thread(target=publish, daemon=True)
+    with contextlib.ExitStack() as stack:
+        if entry is not None:
+            Journal.truncate(entry, filenames)
+        files = open_outputs(stack, filenames, "a" if entry is not None else "w")
+        journal = Journal(journalFilename, files, extra={"range": [start, end]})
+        if entry is not None:
+            journal.restore(entry)
+        else:
+            journal.checkpoint()
+
+        reporter.start()
+        try:
+            records = input_records(args, start, end, firstLine)
+            run_engine(args, resume_records(records, entry), files)
+        finally:
+            stopped.set()
+            reporter.join()
+            if store is not None:
+                store.close()
+            journal.checkpoint()
+            journal.close()
+
+    return {
+        "tested": loopCount,
+        "mismatched": mismatchCount,
+        "exceptions": exceptionCount,
+        "disagree": disagreeCounts,
+        "unchanged": unchangedCount,
+        "duplicates": duplicateCount,
+        "stats": [serverStats.state() for serverStats in stats],
+        "rates": [limiters[server].rate if server in limiters else None for server in servers],
+    }
+
+
+def run_sharded(args, files, shardDir, run):
+    """Run --processes workers over byte ranges of the CSV and merge their output in order."""
+    global progress, loopCount, exceptionCount, mismatchCount, unchangedCount, duplicateCount
+
+    ranges = shard_ranges(args.input_csv, args.processes)
+    context = multiprocessing.get_context("spawn")
+    counts = context.Array("q", 3 * len(ranges), lock=False)
+    progress = Progress(args.input_csv, counts=lambda: (sum(counts[0::3]), sum(counts[1::3])))
+    if metrics is not None:
+        metrics.counts = lambda: (sum(counts[0::3]), sum(counts[1::3]), sum(counts[2::3]))
+
+    os.makedirs(shardDir, exist_ok=args.resume is not None)
+    prefixes = [os.path.join(shardDir, f"{k:03d}") for k in range(len(ranges))]
+    progress.start()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(ranges), mp_context=context,
+                                                    initializer=init_shard_worker,
+                                                    initargs=(counts,)) as pool:
+            futures = [pool.submit(run_shard, args, zones, run, k, start, end, firstLine, prefix)
+                       for k, ((start, end, firstLine), prefix) in enumerate(zip(ranges, prefixes))]
+            results = [future.result() for future in futures]
+    finally:
+        progress.stop()
+        if metrics is not None:
+            metrics.counts = None
+
+    # Copy the shard files straight into the output streams, past the writer's queue
+    for kind in files:
+        files[kind].flush()
+    for prefix in prefixes:
+        for kind, filename in output_filenames(prefix, jsonl=args.jsonl).items():
+            with open(filename, "r") as shardFile, files[kind].writer.ioLock:
+                shutil.copyfileobj(shardFile, files[kind].stream)
+    shutil.rmtree(shardDir)
+
+    loopCount = sum(result["tested"] for result in results)
+    mismatchCount = sum(result["mismatched"] for result in results)
+    exceptionCount = sum(result["exceptions"] for result in results)
+    unchangedCount = sum(result["unchanged"] for result in results)
+    duplicateCount = sum(result["duplicates"] for result in results)
+    for result in results:
+        for serverStats, state in zip(stats, result["stats"]):
+            serverStats.merge(ServerStats(state))
+    for result in results:
+        for i, count in enumerate(result["disagree"]):
+            disagreeCounts[i] += count
+    if limiters:
+        for i, server in enumerate(servers):
+            limiters[server].rate = sum(result["rates"][i] for result in results)
+
+
+# -------------------------
+# MAIN LOGIC
+# -------------------------
+if __name__ == '__main__':
+    args = parse_args()
+    configure(args)
+    reset_counters()
+    inputCsv = args.input_csv
+    startTime = time.time()
+    journal = None
+    store = None
+    zones = None
+    metrics = None
+
+    # -------------------------
+    # Output filenames
+    # -------------------------
+    if args.resume is not None:
+        timeString = args.resume
+    else:
+        now = datetime.now()
+        timeString = now.strftime('%Y%m%d-%H%M%S')
+
+    filenames = output_filenames(f"output/{timeString}", args.compress, args.jsonl)
+    journalFilename = f"output/{timeString}_compare-dns.journal"
+    statsFilename = f"output/{timeString}_stats.json"
+    shardDir = f"output/{timeString}_shards"
+    logFilename = filenames["log"]
+    identicalLogFilename = filenames["identical"]
+    problemsFilename = filenames["problems"]
+    errFilename = filenames["errors"]
+    exceptionsFilename = filenames["exceptions"]
+
+    startLine = "Starting DNS compare between " + " versus ".join(str([server]) for server in servers)
+    if args.reference is not None:
+        startLine += f" (reference {args.reference})"
+
+    # A sharded run rebuilds the merged files from its shards, so only an
+    # unsharded run picks up its own output files where it stopped.
+    entry = None
+    if args.resume is not None:
+        if not os.path.exists(journalFilename):
+            sys.exit(f"Cannot resume: {journalFilename} not found")
+        header, entry = Journal.load(journalFilename)
+        check_resumable(header, args, journalFilename)
+        if args.processes > 1:
+            entry = None
+            if not os.path.isdir(shardDir):
+                sys.exit(f"Cannot resume: {shardDir} not found (the run may have finished)")
+        elif entry is None:
+            sys.exit(f"Cannot resume: {journalFilename} has no checkpoint")
+        else:
+            Journal.truncate(entry, filenames)
+
+    with contextlib.ExitStack() as stack:
+        files = open_outputs(stack, filenames, "a" if entry is not None else "w",
+                             args.compress, args.compress_level)
+
+        headerLines = [
+            startLine,
+            f"Log file: {logFilename}",
+            f"Errors logged in: {errFilename}",
+            f"Exceptions logged in: {exceptionsFilename}",
+            f"Problem items logged in: {problemsFilename}",
+            f"Identical items logged in: {identicalLogFilename}",
+        ]
+        if args.jsonl:
+            headerLines.append(f"JSON results written to: {filenames['results']}")
+        if args.prometheus:
+            headerLines.append(f"Metrics exported to: {args.prometheus}")
+        headerLines.append("-----------------------------")
+
+        print()
+        for line in headerLines:
+            print(line)
+        print()
+
+        # Mirror logs inside file
+        if entry is None:
+            for line in headerLines:
+                print(line, file=files["log"])
+
+        if args.incremental or args.trust_soa:
+            zones = ZoneSerials()
+            zones.discover(inputCsv, digests=args.trust_soa)
+            msg = f"Found {len(zones.serials)} zones with a SOA serial on every server"
+            if args.trust_soa:
+                msg += f", {len(zones.synced)} of them in sync"
+            print(msg)
+
+        if args.prometheus:
+            metrics = MetricsExporter(args.prometheus, startTime)
+            metrics.start()
+
+        if args.axfr or args.zone_files:
+            progress = Progress(None)
+            progress.start()
+            try:
+                if args.zone_files:
+                    run_zones(inputCsv, files, window=1, load=load_zone_file, kind="ZONE")
+                else:
+                    run_zones(inputCsv, files, ZoneCache(args.ixfr_cache) if args.ixfr_cache else None)
+            finally:
+                progress.stop()
+        elif args.processes > 1:
+            if args.resume is None:
+                journal = Journal(journalFilename, files)
+                journal.describe(args)
+                journal.close()
+                journal = None
+            else:
+                print(f"Resuming the shards in {shardDir}")
+            run_sharded(args, files, shardDir, timeString)
+        else:
+            journal = Journal(journalFilename, files)
+            if entry is not None:
+                journal.restore(entry)
+                print(f"Resuming after line {entry['line']} ({loopCount} records already tested)")
             else:
-                print(f"{recName} {recType}: OK identical", file=logfile)
-                print(f"{recName}", file=identicalLog)
+                journal.describe(args)
+                journal.checkpoint()
+
+            if args.incremental:
+                store = ResultStore(args.incremental, timeString)
+            progress = Progress(inputCsv)
+            progress.start()
+            try:
+                run_engine(args, resume_records(input_records(args), entry), files)
+            finally:
+                progress.stop()
+                if store is not None:
+                    store.close()
+                journal.checkpoint()
+                journal.close()
+
+        if logLevel == LOG_SUMMARY:
+            print("", file=files["log"])
+            print(f"Finished. {loopCount} records tested, {mismatchCount} mismatched, {exceptionCount} exceptions.",
+                  file=files["log"])
 
-            # Log raw responses
-            print(f"    {ip1[0]:>16}: {answer1}", file=logfile)
-            print(f"    {ip2[0]:>16}: {answer2}", file=logfile)
+    write_stats(statsFilename)
+    if metrics is not None:
+        metrics.stop()
 
-# Final output
-sys.stdout.write("\b" * 30)
-print(f"Finished. {loopCount} records tested, {mismatchCount} mismatched, {exceptionCount} exceptions.")
-print(f"Finished. {loopCount} records tested, {mismatchCount} mismatched, {exceptionCount} exceptions.")
+    # Final output
+    print(f"Finished. {loopCount} records tested, {mismatchCount} mismatched, {exceptionCount} exceptions.")
+    print(f"Finished. {loopCount} records tested, {mismatchCount} mismatched, {exceptionCount} exceptions.")
+    if duplicateCount:
+        print(f"    {duplicateCount} of them repeats of an earlier line and not queried")
+    if args.incremental or args.trust_soa:
+        print(f"    {unchangedCount} of them not queried, {unchangedCount * len(servers)} queries avoided")
+    elif args.ixfr_cache:
+        print(f"    {unchangedCount} of them unchanged since the last run and not compared")
+    if len(servers) > 2:
+        for server, count in zip(servers, disagreeCounts):
+            print(f"    {server:>16}: disagreed on {count} records")
+    if args.adaptive:
+        for server in servers:
+            print(f"    {server:>16}: settled at {limiters[server].rate:.0f} queries/s")
+    if not (args.axfr or args.zone_files):
+        for server, serverStats in zip(servers, stats):
+            print(f"    {server:>16}: {serverStats.summary()}")
+        print(f"Latency and response statistics written to: {statsFilename}")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# Build the records.csv that compare-dns.py reads from zone transfers or zone files.
+# Usage:
+#     python make-records.py [options] --server <IP> <zone> [<zone> ...]
+#     python make-records.py [options] --zone-files <PATH> <zone> [<zone> ...]
+#
+# Every (owner, type) pair of the zones is written once as an fqdn,type row,
+# in the order the transfer or the zone file lists them. Records are streamed
+# as they arrive, so even very large (reverse) zones are never held in memory.
+# A transfer holds every RRset once, so only its closing SOA is dropped. A
+# zone file may list a name's records anywhere, so the pairs already written
+# are remembered as compact byte strings (about 100 bytes each) to drop
+# repeats.
+#
+# Streaming a zone file relies on dnspython internals that have been checked
+# with dnspython 2.1 to 2.9. With any other version the file is loaded with
+# dns.zone.from_file() instead, one zone at a time: that holds the whole zone
+# in memory (several hundred bytes per record) and lists each name's records
+# together rather than in file order.
+#
+# Options:
+#     --server IP         Transfer the zones (AXFR) from this server
+#     --zone-files PATH   Read the zones from this zone file, or from a
+#                         directory holding <zone>, <zone>.zone, <zone>.db or
+#                         db.<zone> for each of them
+#     --type TYPE         Only list records of this type (may be repeated)
+#     --under NAME        Only list names at or below NAME (may be repeated)
+#     --timeout SECONDS   Longest wait for each message of a zone transfer
+#                         (default: 2.0)
+#     -o, --output FILE   Write the CSV to FILE instead of stdout
+
+import sys
+import csv
+import argparse
+import os
+import dns.name
+import dns.query
+import dns.rdataclass
+import dns.rdatatype
+import dns.tokenizer
+import dns.version
+import dns.zone
+import dns.zonefile
+
+# dnspython releases whose zone file Reader has been checked to work with RecordStream
+STREAMING_VERSIONS = ((2, 1), (2, 9))
+
+
+# -------------------------
+# Argument Check
+# -------------------------
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build a records.csv for compare-dns.py from zone transfers or zone files.'
+    )
+    parser.add_argument('zones', nargs='+', metavar='ZONE', help='Zones to list')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--server', metavar='IP', help='Transfer the zones (AXFR) from this server')
+    source.add_argument('--zone-files', metavar='PATH',
+                        help='Zone file, or directory of zone files, to read the zones from')
+    parser.add_argument('--type', dest='types', action='append', metavar='TYPE',
+                        help='Only list records of this type (may be repeated)')
+    parser.add_argument('--under', action='append', metavar='NAME',
+                        help='Only list names at or below NAME (may be repeated)')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='Longest wait in seconds for each message of a zone transfer (default: 2.0)')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the CSV here instead of stdout')
+    args = parser.parse_args()
+
+    if args.zone_files is not None and len(args.zones) > 1 and not os.path.isdir(args.zone_files):
+        parser.error('--zone-files must be a directory when listing more than one zone')
+    if args.types is not None:
+        try:
+            args.types = {dns.rdatatype.from_text(rdtype) for rdtype in args.types}
+        except dns.rdatatype.UnknownRdatatype as ex:
+            parser.error(f'--type: {ex}')
+    if args.under is not None:
+        args.under = [dns.name.from_text(name) for name in args.under]
+    return args
+
+
+# -------------------------
+# Sources
+# -------------------------
+# Longest a whole zone transfer may take, however steadily the messages arrive
+TRANSFER_LIFETIME = 3600.0
+
+
+def transfer_records(server, zoneName, timeout):
+    """Yield (name, rdtype) for every RRset of a zone transfer, message by message.
+
+    The SOA that closes the transfer is left out, as is an RRset continued
+    from the previous message.
+    """
+    first, last = None, None
+    for message in dns.query.xfr(server, zoneName, relativize=False, timeout=timeout,
+                                 lifetime=TRANSFER_LIFETIME):
+        for rrset in message.answer:
+            pair = (rrset.name, rrset.rdtype)
+            if pair == last or pair == first:
+                continue
+            first = first or pair
+            last = pair
+            yield pair
+
+
+class RecordStream:
+    """Just enough of a dns.transaction.Transaction for dns.zonefile.Reader.
+
+    The reader hands every record to add() as it parses it, so records are
+    passed on straight away instead of being built into a zone. This mirrors
+    what the Reader calls on its transaction and manager, which is not public
+    dnspython API: it is only used for the STREAMING_VERSIONS.
+    """
+
+    def __init__(self, origin, emit):
+        self.manager = self
+        self.origin = origin
+        self.emit = emit
+
+    def origin_information(self):
+        return self.origin, False, self.origin
+
+    def check_put_rdataset(self, check):
+        pass
+
+    def _set_origin(self, origin):
+        pass
+
+    def add_unicode(self, value):
+        pass
+
+    def add(self, name, ttl, rdata):
+        self.emit(name, rdata.rdtype)
+
+
+def zone_file_path(path, zoneName):
+    if not os.path.isdir(path):
+        return path
+    bare = zoneName.rstrip(".")
+    for filename in (bare, f"{bare}.zone", f"{bare}.db", f"db.{bare}"):
+        if os.path.isfile(os.path.join(path, filename)):
+            return os.path.join(path, filename)
+    raise FileNotFoundError(f"no zone file for {bare} in {path}")
+
+
+def read_zone_file(path, zoneName, emit):
+    """Pass (name, rdtype) of every record in a zone file to emit(), in file order."""
+    origin = dns.name.from_text(zoneName)
+    filename = zone_file_path(path, zoneName)
+    low, high = STREAMING_VERSIONS
+    if not low <= (dns.version.MAJOR, dns.version.MINOR) <= high:
+        zone = dns.zone.from_file(filename, origin, relativize=False, check_origin=False)
+        for name, rdataset in zone.iterate_rdatasets():
+            emit(name, rdataset.rdtype)
+        return
+    with open(filename, "r") as zoneFile:
+        tok = dns.tokenizer.Tokenizer(zoneFile, filename)
+        dns.zonefile.Reader(tok, dns.rdataclass.IN, RecordStream(origin, emit)).read()
+
+
+# -------------------------
+# MAIN LOGIC
+# -------------------------
+if __name__ == '__main__':
+    args = parse_args()
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.writer(output, lineterminator="\n")
+    seen = set()
+    rowCount = 0
+
+    def emit(name, rdtype):
+        global rowCount
+
+        if args.types is not None and rdtype not in args.types:
+            return
+        if args.under is not None and not any(name.is_subdomain(under) for under in args.under):
+            return
+        if args.zone_files is not None:
+            key = name.canonicalize().to_wire() + rdtype.to_bytes(2, "big")
+            if key in seen:
+                return
+            seen.add(key)
+        writer.writerow([name.to_text(omit_final_dot=True), dns.rdatatype.to_text(rdtype)])
+        rowCount += 1
+
+    for zoneName in args.zones:
+        try:
+            if args.server is not None:
+                for name, rdtype in transfer_records(args.server, zoneName, args.timeout):
+                    emit(name, rdtype)
+            else:
+                read_zone_file(args.zone_files, zoneName, emit)
+        except Exception as ex:
+            sys.exit(f"Cannot list {zoneName}: {ex}")
+
+    if output is not sys.stdout:
+        output.close()
+    print(f"{rowCount} records listed from {len(args.zones)} zones", file=sys.stderr)